@@ -5,31 +5,47 @@ Extracts structured outline (Title, H1, H2, H3 headings) from PDF files
 """
 
 import os
-import json
 import sys
 import re
+import hashlib
+import mmap
+import multiprocessing
+from collections import defaultdict
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterable, List, Any, Optional
 import fitz  # PyMuPDF
-import pdfplumber
+import orjson
+
+# Default "dict" extraction flags minus image blocks, which would otherwise
+# be decoded on every page but are never used for heading detection
+TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# Parsed outlines are cached by PDF content hash; bump the version whenever
+# a change to the extractor would alter its output
+CACHE_DIR = Path(os.getenv("OUTLINE_CACHE_DIR", "/tmp/outline_cache"))
+CACHE_VERSION = 3
+
+ERROR_TITLE = "Error Processing Document"
 
 
 class PDFOutlineExtractor:
     """Extract structured outline from PDF documents"""
     
     def __init__(self):
-        self.heading_patterns = [
+        self.heading_patterns = {
             # Academic paper specific patterns
-            r"^(\d+\.\d+\.\d+\s+.*)$",  # 1.1.1 Sub-subsection
-            r"^(\d+\.\d+\s+.*)$",      # 1.1 Subsection
-            r"^(\d+\.\s+.*)$",          # 1. Introduction
-            r"^(Abstract|Introduction|Literature Review|Method|Methods|Results|Findings|Discussion|Conclusion|Conclusions|References|Bibliography|Acknowledgements)$", # Common section titles
+            "h3num": r"\d+\.\d+\.\d+\s+.*",  # 1.1.1 Sub-subsection
+            "h2num": r"\d+\.\d+\s+.*",      # 1.1 Subsection
+            "h1num": r"\d+\.\s+.*",          # 1. Introduction
+            "acad": r"(?:Abstract|Introduction|Literature Review|Method|Methods|Results|Findings|Discussion|Conclusion|Conclusions|References)", # Common section titles
+            "backmatter": r"(?:Bibliography|Acknowledgements)",  # Back matter titles
             # General heading patterns
-            r"^([A-Z][A-Z\s]+)$",      # ALL CAPS HEADINGS
-            r"^([A-Z][a-z]+(?:\s+[A-Z][a-z]+)*)$",  # Title Case Headings
-            r"^(Chapter\s+\d+[:\s]*.*)$",  # Chapter headings
-            r"^(Section\s+\d+[:\s]*.*)$",  # Section headings
-        ]
+            "allcap": r"[A-Z][A-Z\s]+",      # ALL CAPS HEADINGS
+            "title": r"[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*",  # Title Case Headings
+            "chap": r"Chapter\s+\d+[:\s]*.*",  # Chapter headings
+            "sect": r"Section\s+\d+[:\s]*.*",  # Section headings
+        }
         self.min_heading_length = 3
         self.max_heading_length = 100
         self.font_size_thresholds = {
@@ -38,11 +54,38 @@ class PDFOutlineExtractor:
             "H3": 12   # Example threshold for H3
         }
         self.min_font_size_for_heading = 10 # Minimum font size to be considered a heading
+        self.min_toc_entries = 3  # Bookmarks needed to trust them over the span scan
+        self._bad_prefixes = ("abstract", "keywords", "the eurocall review", "page")  # Common non-heading text
+        
+        # Compile the bad prefixes and heading patterns once into a single
+        # alternation so each span is scanned once; the named group that
+        # matched identifies the class ("bad" for a case-insensitive prefix)
+        self._heading_pattern = re.compile(
+            "^(?:(?P<bad>(?i:" + "|".join(re.escape(p) for p in self._bad_prefixes) + "))"
+            "|(?:" + "|".join(f"(?P<{name}>{pattern})" for name, pattern in self.heading_patterns.items()) + ")$)"
+        )
+        self._non_word_pattern = re.compile(r"[\W_]+")
+        # Levels implied by the matched heading pattern; the numbered patterns
+        # fully decide the level, so it never needs a second regex pass
+        self._group_to_level = {
+            "h3num": "H3",
+            "h2num": "H2",
+            "h1num": "H1",
+            "acad": "H1",
+            "chap": "H1",
+            "sect": "H2",
+        }
+        # Section keywords that set the level even when the heading patterns
+        # did not match them (any case, or only as a prefix)
+        self._level_keyword_pattern = re.compile(
+            r"^(?:(?P<acad>(?i:Abstract|Introduction|Literature Review|Method|Methods|Results|Findings|Discussion|Conclusion|Conclusions|References))$"
+            r"|(?P<chap>Chapter|CHAPTER)|(?P<sect>Section|SECTION))"
+        )
     
     def extract_outline_pymupdf(self, pdf_path: str) -> Dict[str, Any]:
         """Extract outline using PyMuPDF (primary method)"""
         doc = fitz.open(pdf_path)
-        outline = []
+        outline = defaultdict(list)  # page -> entries
         title = ""
         
         try:
@@ -51,46 +94,40 @@ class PDFOutlineExtractor:
             if metadata and metadata.get("title"):
                 title = metadata["title"].strip()
             
-            # If no title in metadata, try to extract from first page
-            if not title:
-                first_page = doc[0]
-                text = first_page.get_text()
-                lines = text.split("\n")
-                for line in lines[:10]:  # Check first 10 lines
-                    line = line.strip()
-                    if len(line) > 5 and len(line) < 100 and not line.lower().startswith(("abstract", "keywords", "the eurocall review")):
-                        title = line
-                        break
-            
-            # Extract text from all pages and analyze for headings
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                
-                # Get text with formatting information
-                blocks = page.get_text("dict")
-                
-                for block in blocks.get("blocks", []):
-                    if "lines" in block:
-                        for line in block["lines"]:
-                            for span in line.get("spans", []):
-                                text = span.get("text", "").strip()
-                                font_size = span.get("size", 0)
-                                font_flags = span.get("flags", 0)
-                                
-                                if self._is_heading(text, font_size, font_flags):
-                                    level = self._determine_heading_level(text, font_size, font_flags)
-                                    outline.append({
-                                        "level": level,
-                                        "text": text,
-                                        "page": page_num + 1
-                                    })
+            # Bookmarks are authoritative: when the PDF has a real outline,
+            # skip the span scan and only read page 0 for a missing title
+            toc = doc.get_toc()
+            if len(toc) >= self.min_toc_entries:
+                if not title and len(doc):
+                    blocks = doc[0].get_text("dict", flags=TEXT_FLAGS)
+                    title = self._find_title(self._iter_lines(blocks))
+            else:
+                # Extract text from all pages and analyze for headings
+                for page_num, page in enumerate(doc):
+                    # Get text with formatting information
+                    blocks = page.get_text("dict", flags=TEXT_FLAGS)
+                    
+                    # If no title in metadata, try to extract from first page,
+                    # reusing its dict rather than extracting the page twice
+                    if page_num == 0 and not title:
+                        title = self._find_title(self._iter_lines(blocks))
+                    
+                    for text, font_size, font_flags in self._iter_spans(blocks):
+                        kind = self._heading_kind(text, font_size, font_flags)
+                        if kind:
+                            text = text.strip()
+                            level = self._determine_heading_level(text, font_size, font_flags, kind)
+                            outline[page_num + 1].append({
+                                "level": level,
+                                "text": text,
+                                "page": page_num + 1
+                            })
             
             # Also check for bookmarks/outline in PDF
-            toc = doc.get_toc()
             for item in toc:
                 level_num, heading_text, page_num = item
                 level = f"H{min(level_num, 3)}"  # Cap at H3
-                outline.append({
+                outline[page_num].append({
                     "level": level,
                     "text": heading_text.strip(),
                     "page": page_num
@@ -109,7 +146,10 @@ class PDFOutlineExtractor:
     
     def extract_outline_pdfplumber(self, pdf_path: str) -> Dict[str, Any]:
         """Extract outline using pdfplumber (fallback method)"""
-        outline = []
+        # Imported lazily: pdfplumber pulls in pdfminer.six and is rarely needed
+        import pdfplumber
+        
+        outline = defaultdict(list)  # page -> entries
         title = ""
         
         with pdfplumber.open(pdf_path) as pdf:
@@ -117,12 +157,7 @@ class PDFOutlineExtractor:
             if pdf.pages:
                 first_page_text = pdf.pages[0].extract_text()
                 if first_page_text:
-                    lines = first_page_text.split("\n")
-                    for line in lines[:10]:
-                        line = line.strip()
-                        if len(line) > 5 and len(line) < 100 and not line.lower().startswith(("abstract", "keywords", "the eurocall review")):
-                            title = line
-                            break
+                    title = self._find_title(first_page_text.split("\n"))
             
             # Extract text from all pages
             for page_num, page in enumerate(pdf.pages):
@@ -131,9 +166,10 @@ class PDFOutlineExtractor:
                     lines = text.split("\n")
                     for line in lines:
                         line = line.strip()
-                        if self._is_heading_text_only(line):
-                            level = self._determine_heading_level_text_only(line)
-                            outline.append({
+                        kind = self._heading_kind_text_only(line)
+                        if kind:
+                            level = self._determine_heading_level_text_only(line, kind)
+                            outline[page_num + 1].append({
                                 "level": level,
                                 "text": line,
                                 "page": page_num + 1
@@ -146,76 +182,122 @@ class PDFOutlineExtractor:
             "outline": outline
         }
     
-    def _is_heading(self, text: str, font_size: float, font_flags: int) -> bool:
-        """Determine if text is likely a heading based on formatting"""
-        if not text or len(text.strip()) < self.min_heading_length or len(text.strip()) > self.max_heading_length:
-            return False
-        
+    def _find_title(self, lines: Iterable[str]) -> str:
+        """Pick the first plausible title among the first lines of a page"""
+        for line in islice(lines, 10):  # Check first 10 lines
+            line = line.strip()
+            if len(line) > 5 and len(line) < 100 and not line.lower().startswith(("abstract", "keywords", "the eurocall review")):
+                return line
+        return ""
+    
+    @staticmethod
+    def _iter_lines(page_dict: Dict[str, Any]):
+        """Yield the text of each line in a page dict, top to bottom then left to right"""
+        lines = [
+            line
+            for block in page_dict.get("blocks", []) if "lines" in block
+            for line in block["lines"]
+        ]
+        # Same ordering as get_text(sort=True): content order often puts the
+        # title after running headers or page numbers
+        lines.sort(key=lambda line: (line["bbox"][3], line["bbox"][0]))
+        return ("".join(span.get("text", "") for span in line.get("spans", [])) for line in lines)
+    
+    @staticmethod
+    def _iter_spans(page_dict: Dict[str, Any]):
+        """Flatten a page's blocks -> lines -> spans into (text, size, flags) tuples"""
+        return (
+            (span.get("text", ""), span.get("size", 0), span.get("flags", 0))
+            for block in page_dict.get("blocks", []) if "lines" in block
+            for line in block["lines"]
+            for span in line.get("spans", [])
+        )
+    
+    def _classify_heading(self, text: str) -> Optional[str]:
+        """Name the bad prefix or heading pattern text matches, in a single pass"""
+        match = self._heading_pattern.match(text)
+        return match.lastgroup if match else None
+    
+    def _heading_candidate(self, text: str) -> Optional[str]:
+        """Strip text and apply the cheap filters shared by both heading checks"""
         text = text.strip()
+        text_len = len(text)
+        if text_len < 5 or text_len < self.min_heading_length or text_len > self.max_heading_length:
+            return None
         
-        # Filter out common non-heading text that might be bold/large
-        if text.lower().startswith(("abstract", "keywords", "the eurocall review", "page")) or text.isdigit() or text.isspace() or len(text) < 5:
-            return False
+        if text.isdigit():
+            return None
+        
+        return text
+    
+    def _heading_kind(self, text: str, font_size: float, font_flags: int) -> Optional[str]:
+        """Classify text as a heading: the matched pattern name, "font" for
+        formatting-based headings, or None if it is not a heading"""
+        text = self._heading_candidate(text)
+        if not text:
+            return None
 
-        # Check for common heading patterns
-        for pattern in self.heading_patterns:
-            if re.match(pattern, text):
-                return True
+        # Filter out common non-heading text that might be bold/large and
+        # check for common heading patterns
+        kind = self._classify_heading(text)
+        if kind == "bad":
+            return None
+        if kind:
+            return kind
         
         # Check font formatting (bold, larger size)
         is_bold = font_flags & 2**4  # Bold flag
         
         # Heuristics for headings
         if is_bold and font_size >= self.min_font_size_for_heading:
-            return True
+            return "font"
         
         # Consider lines that are significantly larger than body text as potential headings
         if font_size >= self.font_size_thresholds["H2"] and len(text) < 80:
-            return True
+            return "font"
         
-        return False
+        return None
     
-    def _is_heading_text_only(self, text: str) -> bool:
-        """Determine if text is likely a heading based on text patterns only"""
-        if not text or len(text.strip()) < self.min_heading_length or len(text.strip()) > self.max_heading_length:
-            return False
-        
-        text = text.strip()
-        
-        # Filter out common non-heading text
-        if text.lower().startswith(("abstract", "keywords", "the eurocall review", "page")) or text.isdigit() or text.isspace() or len(text) < 5:
-            return False
+    def _heading_kind_text_only(self, text: str) -> Optional[str]:
+        """Classify text as a heading from text patterns only: the matched
+        pattern name, "caps" for short all-caps lines, or None"""
+        text = self._heading_candidate(text)
+        if not text:
+            return None
 
-        # Check for common heading patterns
-        for pattern in self.heading_patterns:
-            if re.match(pattern, text):
-                return True
+        # Filter out common non-heading text and check for common heading patterns
+        kind = self._classify_heading(text)
+        if kind == "bad":
+            return None
+        if kind:
+            return kind
         
         # Additional heuristics for text-only detection
         if len(text) < 80 and text.isupper(): # All caps and short
-            return True
+            return "caps"
         
-        return False
+        return None
     
-    def _determine_heading_level(self, text: str, font_size: float, font_flags: int) -> str:
-        """Determine heading level based on text and formatting"""
-        # Prioritize numbered patterns for academic papers
-        if re.match(r"^\d+\.\d+\.\d+\s+", text):
-            return "H3"
-        elif re.match(r"^\d+\.\d+\s+", text):
-            return "H2"
-        elif re.match(r"^\d+\.\s+", text):
-            return "H1"
+    def _pattern_level(self, text: str, kind: Optional[str]) -> Optional[str]:
+        """Level implied by the heading kind or a section keyword, if any"""
+        if kind is None:
+            kind = self._classify_heading(text)
         
-        # Check for common academic section titles
-        if re.match(r"^(Abstract|Introduction|Literature Review|Method|Methods|Results|Findings|Discussion|Conclusion|Conclusions|References)$", text, re.IGNORECASE):
-            return "H1"
-
-        # Check for chapter/section keywords
-        if re.match(r"^(Chapter|CHAPTER)", text):
-            return "H1"
-        elif re.match(r"^(Section|SECTION)", text):
-            return "H2"
+        level = self._group_to_level.get(kind)
+        if level is None:
+            match = self._level_keyword_pattern.match(text)
+            if match:
+                level = self._group_to_level[match.lastgroup]
+        
+        return level
+    
+    def _determine_heading_level(self, text: str, font_size: float, font_flags: int, kind: Optional[str] = None) -> str:
+        """Determine heading level based on text and formatting"""
+        # Numbered patterns, academic section titles and chapter/section
+        # keywords take priority
+        level = self._pattern_level(text, kind)
+        if level:
+            return level
         
         # Use font size as fallback for non-numbered headings
         if font_size >= self.font_size_thresholds["H1"]:
@@ -225,25 +307,12 @@ class PDFOutlineExtractor:
         else:
             return "H3"
     
-    def _determine_heading_level_text_only(self, text: str) -> str:
+    def _determine_heading_level_text_only(self, text: str, kind: Optional[str] = None) -> str:
         """Determine heading level based on text patterns only"""
-        # Prioritize numbered patterns
-        if re.match(r"^\d+\.\d+\.\d+\s+", text):
-            return "H3"
-        elif re.match(r"^\d+\.\d+\s+", text):
-            return "H2"
-        elif re.match(r"^\d+\.\s+", text):
-            return "H1"
-        
-        # Check for common academic section titles
-        if re.match(r"^(Abstract|Introduction|Literature Review|Method|Methods|Results|Findings|Discussion|Conclusion|Conclusions|References)$", text, re.IGNORECASE):
-            return "H1"
-
-        # Check for keywords
-        if re.match(r"^(Chapter|CHAPTER)", text):
-            return "H1"
-        elif re.match(r"^(Section|SECTION)", text):
-            return "H2"
+        # Numbered patterns, academic section titles and keywords take priority
+        level = self._pattern_level(text, kind)
+        if level:
+            return level
         
         # Default based on text characteristics
         if text.isupper() and len(text) < 50: # All caps and short
@@ -253,20 +322,33 @@ class PDFOutlineExtractor:
         else:
             return "H3"
     
-    def _clean_outline(self, outline: List[Dict]) -> List[Dict]:
-        """Remove duplicates and clean up outline"""
-        seen = set()
+    def _normalize_heading(self, text: str) -> str:
+        """Lowercase text, drop punctuation and collapse whitespace"""
+        return self._non_word_pattern.sub(" ", text.lower()).strip()
+    
+    def _clean_outline(self, outline: Dict[int, List[Dict]]) -> List[Dict]:
+        """Remove duplicates and clean up outline entries grouped by page"""
         cleaned = []
         
-        for item in outline:
-            # Create a key for deduplication (case-insensitive text and page)
-            key = (item["text"].lower(), item["page"])
-            if key not in seen:
-                seen.add(key)
-                cleaned.append(item)
-        
-        # Sort by page number and then by text length (shorter headings first)
-        cleaned.sort(key=lambda x: (x["page"], len(x["text"])))
+        for page in sorted(outline):
+            seen = {}
+            page_items = []
+            
+            for item in outline[page]:
+                # Create a key for deduplication (normalized text), so case,
+                # punctuation and spacing variants of a heading collapse
+                key = self._normalize_heading(item["text"])
+                index = seen.get(key)
+                if index is None:
+                    seen[key] = len(page_items)
+                    page_items.append(item)
+                elif len(item["text"]) < len(page_items[index]["text"]):
+                    # Keep the shortest variant of a duplicated heading
+                    page_items[index] = item
+            
+            # Sort by text length within the page (shorter headings first)
+            page_items.sort(key=lambda x: len(x["text"]))
+            cleaned.extend(page_items)
         
         return cleaned
     
@@ -285,18 +367,56 @@ class PDFOutlineExtractor:
         except Exception as e:
             print(f"Error processing {pdf_path}: {str(e)}", file=sys.stderr)
             return {
-                "title": "Error Processing Document",
+                "title": ERROR_TITLE,
                 "outline": []
             }
 
 
+def file_digest(path: str) -> Optional[str]:
+    """Hash a file's contents in a single mmap pass (None for empty files)"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.blake2b(mapped, digest_size=16).hexdigest()
+
+
 def process_pdf_file(input_path: str, output_path: str):
     """Process a single PDF file and save the outline as JSON"""
+    try:
+        digest = file_digest(input_path)
+    except OSError:
+        # Unreadable input: skip the cache and let extract_outline report it
+        digest = None
+    cache_path = CACHE_DIR / f"v{CACHE_VERSION}-{digest}.json" if digest else None
+    
+    # Reuse the outline from a previous run on identical content; a missing
+    # or corrupt cache entry falls back to parsing
+    if cache_path and cache_path.exists():
+        try:
+            cached = cache_path.read_bytes()
+            orjson.loads(cached)
+            Path(output_path).write_bytes(cached)
+            print(f"Processed (cached): {input_path} -> {output_path}")
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ignoring cached outline for {input_path}: {str(e)}", file=sys.stderr)
+    
     extractor = PDFOutlineExtractor()
     result = extractor.extract_outline(input_path)
+    data = orjson.dumps(result, option=orjson.OPT_INDENT_2)
+    
+    Path(output_path).write_bytes(data)
     
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, indent=2, ensure_ascii=False)
+    if cache_path and result["title"] != ERROR_TITLE:
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # Write then rename so concurrent workers never see a partial file
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not cache outline for {input_path}: {str(e)}", file=sys.stderr)
     
     print(f"Processed: {input_path} -> {output_path}")
 
@@ -316,9 +436,11 @@ def main():
         print("No PDF files found in input directory")
         return
     
-    for pdf_file in pdf_files:
-        output_file = output_dir / f"{pdf_file.stem}.json"
-        process_pdf_file(str(pdf_file), str(output_file))
+    # Files are independent and parsing is CPU-bound, so process them in parallel
+    jobs = [(str(pdf_file), str(output_dir / f"{pdf_file.stem}.json")) for pdf_file in pdf_files]
+    processes = min(len(jobs), os.cpu_count() or 1)
+    with multiprocessing.Pool(processes=processes) as pool:
+        pool.starmap(process_pdf_file, jobs)
     
     print(f"Processed {len(pdf_files)} PDF files")
 
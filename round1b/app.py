@@ -6,13 +6,21 @@ Flask API for persona-driven document analysis and question answering
 
 import os
 import json
+import hashlib
 import logging
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Any, Optional
-from flask import Flask, request, jsonify, render_template_string
-import openai
+from typing import Dict, Iterator, List, Any, Optional
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context
+from openai import OpenAI
 import fitz  # PyMuPDF
-import pdfplumber
+import tiktoken
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -24,9 +32,63 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Configure OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
-openai.api_base = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+@lru_cache(maxsize=None)
+def get_openai_client() -> OpenAI:
+    """Shared OpenAI client, so requests reuse its pooled keep-alive connections"""
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        base_url=os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1"),
+    )
+
+# Background thread for connection warm-ups; at most one is started per
+# idle period, so work cannot pile up even when the API is unreachable
+executor = ThreadPoolExecutor(max_workers=1)
+
+# Pooled connections are dropped after httpx's default keep-alive expiry
+OPENAI_IDLE_SECONDS = 5.0
+_last_openai_use = 0.0
+_openai_use_lock = threading.Lock()
+
+def mark_openai_used():
+    """Record that the pooled OpenAI connection was just used"""
+    global _last_openai_use
+    with _openai_use_lock:
+        _last_openai_use = time.monotonic()
+
+def warm_openai_connection():
+    """Open (or refresh) a pooled connection to the OpenAI API ahead of use"""
+    try:
+        # Short timeout and no retries: this is best effort and must not tie
+        # up the pool; with_options shares the client's connection pool
+        get_openai_client().with_options(timeout=5, max_retries=0).models.list()
+    except Exception as e:
+        logger.warning(f"OpenAI connection warm-up failed: {str(e)}")
+
+def warm_openai_connection_if_idle():
+    """Warm the OpenAI connection in the background unless it was used recently"""
+    global _last_openai_use
+    with _openai_use_lock:
+        now = time.monotonic()
+        if now - _last_openai_use < OPENAI_IDLE_SECONDS:
+            return
+        # Claim this idle period so concurrent requests do not warm up too
+        _last_openai_use = now
+    executor.submit(warm_openai_connection)
+
+# Only a successfully loaded encoding is kept, so failed loads are retried
+_token_encoding = None
+
+def get_token_encoding() -> Optional[tiktoken.Encoding]:
+    """Tokenizer for the analysis model, or None if it cannot be loaded"""
+    global _token_encoding
+    if _token_encoding is None:
+        try:
+            _token_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        except Exception as e:
+            # The BPE file is downloaded on first use; without it fall back
+            # to truncating by characters for this request
+            logger.warning(f"Could not load tiktoken encoding: {str(e)}")
+    return _token_encoding
 
 class DocumentIntelligence:
     """Persona-driven document intelligence system"""
@@ -54,40 +116,94 @@ class DocumentIntelligence:
                 "style": "accessible, comprehensive, well-structured"
             }
         }
+        
+        # Token budget for the document excerpt sent to the model: the head
+        # of the document plus its tail, where conclusions usually are
+        self.document_head_tokens = 3000
+        self.document_tail_tokens = 1000
+        # Characters per budgeted token in the window tokenized at each end
+        # of long documents; a heuristic, as tokens can be much longer
+        self.window_chars_per_token = 8
+        
+        # LRU cache of analyses keyed by (document hash, persona, query);
+        # shared by the worker's request threads, hence the lock
+        self.analysis_cache_size = 1024
+        self._analysis_cache = OrderedDict()
+        self._analysis_cache_lock = threading.Lock()
     
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """Extract text content from PDF file"""
         try:
             # Try PyMuPDF first
             doc = fitz.open(pdf_path)
-            text = ""
+            parts = []
             for page in doc:
-                text += page.get_text()
+                parts.append(page.get_text())
             doc.close()
+            text = "".join(parts)
             
             if text.strip():
                 return text
             
-            # Fallback to pdfplumber
+            # Fallback to pdfplumber, imported lazily as it pulls in pdfminer.six
+            import pdfplumber
             with pdfplumber.open(pdf_path) as pdf:
-                text = ""
+                parts = []
                 for page in pdf.pages:
                     page_text = page.extract_text()
                     if page_text:
-                        text += page_text + "\n"
+                        parts.append(page_text + "\n")
             
-            return text
+            return "".join(parts)
         
         except Exception as e:
             logger.error(f"Error extracting text from PDF: {str(e)}")
             return ""
     
-    def analyze_document(self, text: str, persona: str, query: str = None) -> Dict[str, Any]:
-        """Analyze document based on persona and optional query"""
-        if persona not in self.personas:
-            persona = "general"
+    def _resolve_persona(self, persona: str) -> str:
+        """Fall back to the general persona for unknown names"""
+        return persona if persona in self.personas else "general"
+    
+    def _truncate_document(self, text: str) -> str:
+        """Fit the document into the token budget, keeping its head and tail"""
+        budget = self.document_head_tokens + self.document_tail_tokens
+        # Every token covers at least one UTF-8 byte (but a CJK character or
+        # emoji may span several tokens); only short texts need the encode
+        if len(text) <= budget and len(text.encode("utf-8")) <= budget:
+            return text
+        
+        encoding = get_token_encoding()
+        if encoding is None:
+            return text[:budget]
+        
+        head_window = self.document_head_tokens * self.window_chars_per_token
+        tail_window = self.document_tail_tokens * self.window_chars_per_token
+        
+        head_tokens = tail_tokens = None
+        if len(text) > head_window + tail_window:
+            # Only tokenize a bounded window at each end of long documents
+            head_tokens = encoding.encode(text[:head_window], disallowed_special=())[:self.document_head_tokens]
+            tail_tokens = encoding.encode(text[-tail_window:], disallowed_special=())[-self.document_tail_tokens:]
+            if len(head_tokens) + len(tail_tokens) < budget:
+                # Long tokens (runs of spaces, dot leaders) left the windows
+                # short of the budget; the whole text may fit after all
+                head_tokens = tail_tokens = None
+        
+        if head_tokens is None:
+            tokens = encoding.encode(text, disallowed_special=())
+            if len(tokens) <= budget:
+                return text
+            head_tokens = tokens[:self.document_head_tokens]
+            tail_tokens = tokens[-self.document_tail_tokens:]
         
+        head = encoding.decode(head_tokens)
+        tail = encoding.decode(tail_tokens)
+        return f"{head}\n...\n{tail}"
+    
+    def _build_messages(self, text: str, persona: str, query: str = None) -> List[Dict[str, str]]:
+        """Build the chat messages for a persona and optional query"""
         persona_info = self.personas[persona]
+        document_text = self._truncate_document(text)
         
         # Prepare the prompt based on persona
         if query:
@@ -98,7 +214,7 @@ Focus on: {persona_info['focus']}
 Response style: {persona_info['style']}
 
 Document text:
-{text[:4000]}  # Limit text to avoid token limits
+{document_text}
 
 User question: {query}
 
@@ -112,7 +228,7 @@ Focus on: {persona_info['focus']}
 Response style: {persona_info['style']}
 
 Document text:
-{text[:4000]}  # Limit text to avoid token limits
+{document_text}
 
 Please provide a comprehensive analysis of this document tailored to the {persona} persona. Include:
 1. Key insights relevant to this persona
@@ -123,18 +239,56 @@ Please provide a comprehensive analysis of this document tailored to the {person
 Format your response in a clear, structured manner.
 """
         
+        return [
+            {"role": "system", "content": f"You are a helpful assistant specializing in document analysis for {persona_info['description']}."},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _create_completion(self, messages: List[Dict[str, str]], stream: bool = False):
+        """Send a chat completion request through the shared client"""
+        response = get_openai_client().chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            max_tokens=1500,
+            temperature=0.3,
+            stream=stream
+        )
+        mark_openai_used()
+        return response
+    
+    def _analysis_cache_key(self, text: str, persona: str, query: Optional[str]) -> tuple:
+        """Key an analysis by a digest of the document rather than its full text"""
+        return (hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest(), persona, query)
+    
+    def _get_cached_analysis(self, key: tuple) -> Optional[str]:
+        """Return a cached analysis and mark it as recently used"""
+        with self._analysis_cache_lock:
+            analysis = self._analysis_cache.get(key)
+            if analysis is not None:
+                self._analysis_cache.move_to_end(key)
+            return analysis
+    
+    def _cache_analysis(self, key: tuple, analysis: str):
+        """Store an analysis, evicting the least recently used beyond the limit"""
+        with self._analysis_cache_lock:
+            self._analysis_cache[key] = analysis
+            self._analysis_cache.move_to_end(key)
+            while len(self._analysis_cache) > self.analysis_cache_size:
+                self._analysis_cache.popitem(last=False)
+    
+    def analyze_document(self, text: str, persona: str, query: str = None) -> Dict[str, Any]:
+        """Analyze document based on persona and optional query"""
+        persona = self._resolve_persona(persona)
+        persona_info = self.personas[persona]
+        cache_key = self._analysis_cache_key(text, persona, query)
+        
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": f"You are a helpful assistant specializing in document analysis for {persona_info['description']}."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=1500,
-                temperature=0.3
-            )
-            
-            analysis = response.choices[0].message.content
+            # Identical requests skip the OpenAI round trip
+            analysis = self._get_cached_analysis(cache_key)
+            if analysis is None:
+                response = self._create_completion(self._build_messages(text, persona, query))
+                analysis = response.choices[0].message.content
+                self._cache_analysis(cache_key, analysis)
             
             return {
                 "persona": persona,
@@ -152,6 +306,25 @@ Format your response in a clear, structured manner.
                 "query": query,
                 "status": "error"
             }
+    
+    def stream_analysis(self, text: str, persona: str, query: str = None) -> Iterator[str]:
+        """Yield the analysis text incrementally as the model generates it"""
+        persona = self._resolve_persona(persona)
+        cache_key = self._analysis_cache_key(text, persona, query)
+        
+        cached = self._get_cached_analysis(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        parts = []
+        for chunk in self._create_completion(self._build_messages(text, persona, query), stream=True):
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        
+        # Only cache analyses that were streamed to completion
+        self._cache_analysis(cache_key, "".join(parts))
 
 # Initialize the document intelligence system
 doc_intel = DocumentIntelligence()
@@ -199,6 +372,7 @@ def index():
                 <li><code>file</code> (required): PDF file to analyze</li>
                 <li><code>persona</code> (optional): One of student, researcher, business_analyst, general (default: general)</li>
                 <li><code>query</code> (optional): Specific question about the document</li>
+                <li><code>stream</code> (optional): Set to <code>true</code> to receive the analysis incrementally as Server-Sent Events</li>
             </ul>
         </div>
         
@@ -246,6 +420,17 @@ def get_personas():
     """Get available personas"""
     return jsonify({"personas": doc_intel.personas})
 
+def _sse_analysis(text: str, persona: str, query: Optional[str]) -> Iterator[str]:
+    """Format a streamed analysis as Server-Sent Events"""
+    try:
+        for content in doc_intel.stream_analysis(text, persona, query):
+            yield f"data: {json.dumps({'content': content})}\n\n"
+        yield f"data: {json.dumps({'status': 'success'})}\n\n"
+    except Exception as e:
+        logger.error(f"Error in streamed analysis: {str(e)}")
+        error = f"Error analyzing document: {str(e)}"
+        yield f"data: {json.dumps({'status': 'error', 'error': error})}\n\n"
+
 @app.route('/analyze', methods=['POST'])
 def analyze_document():
     """Analyze uploaded PDF document with persona-driven intelligence"""
@@ -265,18 +450,33 @@ def analyze_document():
         # Get parameters
         persona = request.form.get('persona', 'general')
         query = request.form.get('query', None)
+        stream = request.form.get('stream', 'false').lower() in ('1', 'true', 'yes')
         
-        # Save uploaded file temporarily
-        temp_path = f"/tmp/{file.filename}"
-        file.save(temp_path)
+        # Stream the upload to a uniquely named temp file in 64 KB chunks;
+        # the client-supplied filename is never used as a path
+        with tempfile.NamedTemporaryFile(suffix=".pdf", dir="/tmp", delete=False) as tmp:
+            temp_path = tmp.name
         
         try:
+            with open(temp_path, "wb") as dst:
+                shutil.copyfileobj(file.stream, dst, length=64 * 1024)
+            
+            # If the pooled OpenAI connection has gone idle, re-open it while
+            # the text is extracted, so the TLS handshake overlaps MuPDF's
+            # work (which releases the GIL)
+            warm_openai_connection_if_idle()
+            
             # Extract text from PDF
             text = doc_intel.extract_text_from_pdf(temp_path)
             
             if not text.strip():
                 return jsonify({"error": "Could not extract text from PDF"}), 400
             
+            # Stream the analysis as Server-Sent Events if requested
+            if stream:
+                return Response(stream_with_context(_sse_analysis(text, persona, query)),
+                                mimetype='text/event-stream')
+            
             # Analyze document
             result = doc_intel.analyze_document(text, persona, query)
             
@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+"""
+Adobe India Hackathon - Round 1B: WSGI entry point
+Serve with: gunicorn -w 4 -k gthread --threads 4 -b 0.0.0.0:5000 wsgi:app
+"""
+
+from app import app